@@ -25,34 +25,99 @@ class Llama3LM(LM):
                  model_name,
                  model_dir=None,
                  cache_file=None,
-                 mode="afv"):
+                 mode="afv",
+                 draft_model=None,
+                 quantization=None):
         if mode not in {"afv","afg"}:
             raise ValueError(f"allowed modes are afg, afv. Not {mode}")
         self.mode = mode
         self.model_name = model_name
         self.model_dir = model_dir
+        # e.g. "meta-llama/Llama-3.2-1B-Instruct"; enables speculative
+        # decoding on the vLLM path when set
+        self.draft_model = draft_model
+        # on the vLLM path the method of a prequantized checkpoint, e.g.
+        # "gptq" or "awq"; on the transformers path any value switches to
+        # bitsandbytes LLM.int8() loading
+        self.quantization = quantization
         if cache_file:
             super().__init__(cache_file)
         self.logger = logging.getLogger(self.__class__.__name__)
         self.logits = False
+        self.use_vllm = False
+        self._afv_template = None
 
     def load_model(self):
-        if self.model_dir:
-            self.model = AutoModelForCausalLM.from_pretrained(self.model_dir).to("cuda")
-        else:
-            self.model = AutoModelForCausalLM.from_pretrained(self.model_name).to("cuda")
-        # self.model = convert_model_to_int8_on_gpu(self.mdel, device='cuda')
+        # Prefer vLLM when available: one batched generate call saturates the
+        # GPU instead of one kernel launch per prompt. Fall back to the HF
+        # model otherwise.
+        try:
+            from vllm import LLM
+            # Atoms of the same topic share a long retrieved-context prefix;
+            # prefix caching prefills it once per topic instead of once per atom.
+            llm_kwargs = dict(model=self.model_dir if self.model_dir else self.model_name,
+                              dtype="bfloat16",
+                              max_model_len=2048,
+                              gpu_memory_utilization=0.9,
+                              enable_prefix_caching=True)
+            if self.draft_model:
+                # the afv answer is nearly always " True"/" False", so a tiny
+                # draft model gets accepted almost every step and the big
+                # model only runs verification passes
+                llm_kwargs["speculative_config"] = {"model": self.draft_model,
+                                                    "num_speculative_tokens": 4}
+            if self.quantization:
+                llm_kwargs["quantization"] = self.quantization
+            self.model = LLM(**llm_kwargs)
+            self.use_vllm = True
+        except ImportError:
+            self.logger.debug("vLLM not available, falling back to transformers")
+            self.use_vllm = False
+            if self.quantization:
+                # weight-only INT8: halves HBM reads again vs bfloat16 during
+                # the memory-bound decode
+                from transformers import BitsAndBytesConfig
+                model_kwargs = {"quantization_config": BitsAndBytesConfig(load_in_8bit=True,
+                                                                          llm_int8_threshold=6.0),
+                                "device_map": "cuda"}
+            else:
+                model_kwargs = {"torch_dtype": torch.bfloat16, "device_map": "cuda"}
+            self.model = AutoModelForCausalLM.from_pretrained(self.model_dir if self.model_dir else self.model_name,
+                                                              **model_kwargs)
+            # fuse the eager per-op kernel launches into CUDA graphs; the
+            # static KV cache keeps the compiled shapes stable across decodes
+            self.model.generation_config.cache_implementation = "static"
+            self.model = torch.compile(self.model, mode="reduce-overhead", fullgraph=False)
+        self._load_tokenizer()
+        if not self.use_vllm:
+            self.model.generation_config.pad_token_id = self.tokenizer.eos_token_id
+            self.logger.debug(f"Loaded model name: {self.model.config._name_or_path}")
+            # one dummy generate so graph capture happens before real traffic
+            warmup = self.tokenizer("True or False?", return_tensors="pt").to("cuda")
+            self.model.generate(**warmup, max_new_tokens=1)
+
+    def _load_tokenizer(self):
         self.tokenizer = AutoTokenizer.from_pretrained(self.model_name)
         # setting pad token as end of sentence token
         self.tokenizer.pad_token=self.tokenizer.eos_token
-        self.model.generation_config.pad_token_id = self.tokenizer.eos_token_id
-        self.logger.debug(f"Loaded model name: {self.model.config._name_or_path}")
+        # left padding keeps the last prompt token (and the generated tokens)
+        # at the same positions for every row of a padded batch
+        self.tokenizer.padding_side = "left"
+        # token ids of the answer tokens, used by score_true_false; the chat
+        # template ends with a newline so the answer carries no leading space
+        self.true_id = self.tokenizer.convert_tokens_to_ids("True")
+        self.false_id = self.tokenizer.convert_tokens_to_ids("False")
         # Defining Chat_template
 #        chat_template = open('/netscratch/fonseca/OpenFActScore/.cache/llama-3-instruct.jinja').read()
         chat_template = LLAMA_3_INSTRUCT_TEMPLATE
         chat_template = chat_template.replace('    ', '').replace('\n', '')
         self.tokenizer.chat_template = chat_template
 
+    def _sampling_params(self, **kwargs):
+        # overridable hook so engine siblings can supply their own class
+        from vllm import SamplingParams
+        return SamplingParams(**kwargs)
+
     def unload_model(self):
         """
         Unloads the model and clears the memory.
@@ -69,45 +134,66 @@ class Llama3LM(LM):
             prompts = [prompts]
         
         if self.mode=="afv":
-            max_output_length = 3
+            # "True"/"False" are single tokens for the llama3 tokenizer, so
+            # every extra decode step is a wasted forward through the weights
+            max_output_length = 1
         prompts = self.chat_formatter(prompts)
-        tokens = self.tokenizer(prompts)
-        input_ids = tokens.input_ids
-        attention_masks = tokens.attention_mask
-        if verbose:
-            input_ids = tqdm(input_ids)
+
+        if self.use_vllm:
+            generations, scores = self._generate_vllm(prompts, max_output_length,
+                                                      end_if_newline=end_if_newline,
+                                                      end_if_second_newline=end_if_second_newline)
+            assert len(generations)==len(prompts)==len(scores)
+            if is_single:
+                return generations[0], scores[0]
+            return generations, scores
 
         generations = []
         scores = []
-        for curr_input_ids, attention_mask in zip(input_ids, attention_masks):
-            curr_input_ids = torch.LongTensor([curr_input_ids]).cuda()
-            attention_mask = torch.LongTensor([attention_mask]).cuda()
+        # pad each chunk once and move it to the GPU in a single copy instead
+        # of one synchronous H2D transfer per prompt
+        batch_size = 8
+        batch_starts = range(0, len(prompts), batch_size)
+        if verbose:
+            batch_starts = tqdm(batch_starts)
+        for batch_start in batch_starts:
+            batch_prompts = prompts[batch_start:batch_start + batch_size]
+            tokens = self.tokenizer(batch_prompts, padding=True, truncation=True,
+                                    max_length=max_sequence_length, return_tensors="pt").to("cuda")
             gen_outputs = self.model.generate(
-                curr_input_ids,
-                attention_mask=attention_mask,
+                tokens.input_ids,
+                attention_mask=tokens.attention_mask,
                 max_new_tokens=max_output_length,
                 return_dict_in_generate=True,
                 output_scores=True
             )
             gen_tokens = gen_outputs["sequences"]
-            # saving the logits for the very first token
-            gen_scores = gen_outputs["scores"][0][0].detach().cpu().numpy()
-            gen = self.tokenizer.decode(gen_tokens[0, curr_input_ids.shape[-1]:])
+            # with left padding every generation starts right after the prompt
+            input_length = tokens.input_ids.shape[1]
+            for i in range(len(batch_prompts)):
+                # saving the logits for the very first token; in afv mode only
+                # the two FP16 answer logits cross the PCIe bus instead of the
+                # full-vocab FP32 vector
+                if self.mode=="afv":
+                    gen_scores = gen_outputs["scores"][0][i, [self.true_id, self.false_id]].half().cpu().numpy()
+                else:
+                    gen_scores = gen_outputs["scores"][0][i].detach().half().cpu().numpy()
+                gen = self.tokenizer.decode(gen_tokens[i, input_length:], skip_special_tokens=True)
 
-            if end_if_newline:
-                gen = gen.split("\n")[0].strip()
-            elif end_if_second_newline:
-                gen = "\n".join(gen.split("\n")[:2]).strip()
+                if end_if_newline:
+                    gen = gen.split("\n")[0].strip()
+                elif end_if_second_newline:
+                    gen = "\n".join(gen.split("\n")[:2]).strip()
 
-            if verbose and len(generations)==0:
-                print ("Input:", prompts[0])
-                print ("Prediction:", gen)
+                if verbose and len(generations)==0:
+                    print ("Input:", prompts[0])
+                    print ("Prediction:", gen)
 
-            if self.model_name.startswith("llama-sni"):
-                gen = en.split("</s>")[0]
-            self.logger.debug("scores: %s\ntokens:%s\ngen:%s", gen_scores, gen_tokens, gen)
-            generations.append(gen)
-            scores.append(gen_scores)
+                if self.model_name.startswith("llama-sni"):
+                    gen = gen.split("</s>")[0]
+                self.logger.debug("scores: %s\ngen:%s", gen_scores, gen)
+                generations.append(gen)
+                scores.append(gen_scores)
 
         assert len(generations)==len(prompts)==len(scores)
         if is_single:
@@ -115,6 +201,96 @@ class Llama3LM(LM):
         
         return generations, scores
 
+    def score_true_false(self, prompts, max_sequence_length=2048):
+        """
+        Score the True/False answer of each prompt directly instead of running
+        an autoregressive generate and parsing the output. Returns an (N, 2)
+        numpy array with the [True, False] logits, one row per prompt.
+        Results are cached per prompt like `generate`.
+        """
+        is_single = type(prompts)==str
+        if is_single:
+            prompts = [prompts]
+        prompts = [prompt.strip() for prompt in prompts]
+        cache_keys = [f"{prompt}_tf" for prompt in prompts]
+        results = [self.cache_dict.get(cache_key) for cache_key in cache_keys]
+
+        missing = [i for i, result in enumerate(results) if result is None]
+        if missing:
+            if self.model is None:
+                self.load_model()
+            scores = self._score_true_false([prompts[i] for i in missing], max_sequence_length)
+            for i, score in zip(missing, scores):
+                results[i] = score
+                self.cache_dict[cache_keys[i]] = score
+                self.add_n += 1
+
+        results = np.stack(results)
+        if is_single:
+            return results[0]
+        return results
+
+    def _score_true_false(self, prompts, max_sequence_length):
+        prompts = self.chat_formatter(prompts)
+
+        if self.use_vllm:
+            sampling_params = self._sampling_params(temperature=0.0, max_tokens=1, logprobs=20)
+            outputs = self.model.generate(prompts, sampling_params)
+            scores = []
+            for output in outputs:
+                logprobs = output.outputs[0].logprobs[0]
+                true_score = logprobs[self.true_id].logprob if self.true_id in logprobs else -math.inf
+                false_score = logprobs[self.false_id].logprob if self.false_id in logprobs else -math.inf
+                scores.append(np.array([true_score, false_score], dtype=np.float32))
+            return scores
+
+        # same chunking as _generate: a full-topic batch in one forward would
+        # materialize (N, seq_len, vocab) logits and OOM; logits_to_keep=1
+        # limits the computed logits to the last position
+        scores = []
+        batch_size = 8
+        for batch_start in range(0, len(prompts), batch_size):
+            batch_prompts = prompts[batch_start:batch_start + batch_size]
+            tokens = self.tokenizer(batch_prompts, padding=True, truncation=True,
+                                    max_length=max_sequence_length, return_tensors="pt").to("cuda")
+            with torch.no_grad():
+                logits = self.model(tokens.input_ids, attention_mask=tokens.attention_mask,
+                                    logits_to_keep=1).logits
+            # with left padding the last prompt token sits at position -1; only
+            # the (N, 2) FP16 slice ever leaves the GPU
+            true_false_logits = logits[:, -1, [self.true_id, self.false_id]].half()
+            scores.extend(true_false_logits.cpu().numpy())
+        return scores
+
+    def _generate_vllm(self, prompts, max_output_length,
+                       end_if_newline=False, end_if_second_newline=False):
+        """
+        Generate for all prompts in a single batched call through the vLLM
+        engine (PagedAttention + continuous batching).
+        """
+        sampling_params = self._sampling_params(temperature=0.0,
+                                                max_tokens=max_output_length,
+                                                logprobs=20)
+        outputs = self.model.generate(prompts, sampling_params)
+
+        generations = []
+        scores = []
+        for output in outputs:
+            gen = output.outputs[0].text
+            # logprobs of the very first generated token, keyed by token id
+            gen_scores = {token_id: logprob.logprob
+                          for token_id, logprob in output.outputs[0].logprobs[0].items()}
+
+            if end_if_newline:
+                gen = gen.split("\n")[0].strip()
+            elif end_if_second_newline:
+                gen = "\n".join(gen.split("\n")[:2]).strip()
+
+            self.logger.debug("scores: %s\ngen:%s", gen_scores, gen)
+            generations.append(gen)
+            scores.append(gen_scores)
+        return generations, scores
+
     def chat_formatter(self, prompts:list):
         """
         Apply the chat formatter and include system prompt for proper llama3.1 prompting
@@ -124,7 +300,20 @@ class Llama3LM(LM):
 
         for prompt in prompts:
             if self.mode=="afv":
-                system_instruct = "You are an annotator that verifies the factuality of a sentence according to a given source text. You answer only True or False and provide no further explanations."
+                # every afv prompt uses the same system instruction, so the
+                # Jinja template is rendered once and reused as plain strings
+                if self._afv_template is None:
+                    system_instruct = "You are an annotator that verifies the factuality of a sentence according to a given source text. You answer only True or False and provide no further explanations."
+                    sentinel = "<<user_content>>"
+                    instruct_dict = [{"role" : "system", "content": system_instruct},
+                                     {"role": "user", "content": sentinel}]
+                    rendered = self.tokenizer.apply_chat_template(instruct_dict, tokenize=False, add_generation_prompt=True)
+                    self._afv_template = rendered.split(sentinel)
+                prefix, suffix = self._afv_template
+                cur_prompt = prefix + prompt.strip() + suffix
+                formatted_prompts.append(cur_prompt)
+                self.logger.debug("After Formatter prompt: %s", cur_prompt)
+                continue
             else:
                 _instruct = """
                 You are an annotator that breaks down sentences into independent facts, short statements that each contain one piece of information contained in the given sentence.
@@ -5,15 +5,22 @@ import logging
 import os
 import numpy as np
 
+from concurrent.futures import ThreadPoolExecutor
+from itertools import chain
+
 from tqdm import tqdm
 from factscore.abstain_detection import is_response_abstained
-from factscore.atomic_facts import AtomicFactGenerator
-from factscore.clm import CLM
-from factscore.npm import NPM
-from factscore.openai_lm import OpenAIModel
-from factscore.Llama3LM import Llama3LM
-from factscore.HFmodel import HFmodel
-from factscore.retrieval import DocDB, Retrieval
+
+# the model and retrieval modules transitively pull in torch, transformers,
+# sentence-transformers etc.; they are imported lazily in the branch that
+# actually needs them so small jobs do not pay seconds of cold start
+
+# precomputed once for the string-based True/False fallback in _get_score
+_PUNCT_TABLE = str.maketrans("", "", string.punctuation)
+_NEG_KEYWORDS = frozenset(["not", "cannot", "unknown", "information"])
+
+# verification prompt layout, formatted once per atom in _get_score
+_PROMPT_TEMPLATE = "Answer the question about {topic} based on the given context.\n\n{context}\n\nInput: {atom} True or False?\nAnswer:"
 
 class FactScorer(object):
     def __init__(self,
@@ -28,7 +35,10 @@ class FactScorer(object):
                  openai_key="api.key",
                  cost_estimate="consider_cache",
                  abstain_detection_type=None,
-                 batch_size=256):
+                 batch_size=256,
+                 afv_draft_model=None,
+                 afv_quantization=None,
+                 backend=None):
         self.afg_model = afg_model
         self.afv_model = afv_model
         self.is_npm = is_npm
@@ -50,17 +60,26 @@ class FactScorer(object):
         self.af_generator = None
         self.cost_estimate = cost_estimate
         if "inst-llama" in self.model_name:
+            from factscore.clm import CLM
             self.lm = CLM("inst-llama-7B",
                           model_dir=os.path.join(model_dir, "inst-llama-7B"),
                           cache_file=os.path.join(cache_dir, "inst-llama-7B.pkl"))
         elif "ChatGPT" in self.model_name:
+            from factscore.openai_lm import OpenAIModel
             self.lm = OpenAIModel("ChatGPT",
                                   cache_file=os.path.join(cache_dir, "ChatGPT.pkl"),
                                   key_path=openai_key)
         elif "Llama-3.1" in self.afv_model:
-            self.lm = Llama3LM(self.afv_model,
-                                cache_file=os.path.join(cache_dir, self.model_name))
+            if (backend or os.environ.get("OPENFACTSCORE_BACKEND")) == "trtllm":
+                from factscore.Llama3LMTRT import Llama3LMTRT as afv_cls
+            else:
+                from factscore.Llama3LM import Llama3LM as afv_cls
+            self.lm = afv_cls(self.afv_model,
+                                cache_file=os.path.join(cache_dir, self.model_name),
+                                draft_model=afv_draft_model,
+                                quantization=afv_quantization)
         else:
+            from factscore.HFmodel import HFmodel
             self.lm = HFmodel(self.afv_model,
                                 cache_file=os.path.join(cache_dir, self.model_name),
                                 logits=self.is_logits)
@@ -86,6 +105,7 @@ class FactScorer(object):
             v.save_cache()
 
     def register_knowledge_source(self, name="enwiki-20230401", db_path=None, data_path=None):
+        from factscore.retrieval import DocDB, Retrieval
         assert name not in self.retrieval, f"{name} already registered"
         if db_path is None:
             db_path = os.path.join(self.data_dir, f"{name}.db")
@@ -93,13 +113,14 @@ class FactScorer(object):
         if data_path is None:
             data_path = os.path.join(self.data_dir, f"{name}.jsonl")
 
-        cache_path = os.path.join(self.cache_dir, f"retrieval-{name}.json")
+        cache_path = os.path.join(self.cache_dir, f"retrieval-{name}.sqlite3")
         embed_cache_path = os.path.join(self.cache_dir, f"retrieval-{name}.pkl")
 
         self.db[name] = DocDB(db_path=db_path, data_path=data_path)
         self.retrieval[name] = Retrieval(self.db[name], cache_path, embed_cache_path, batch_size=self.batch_size)
         if "npm" in self.model_name:
-            cache_path = os.path.join(self.cache_dir, f"bm25-{name}.json")
+            from factscore.npm import NPM
+            cache_path = os.path.join(self.cache_dir, f"bm25-{name}.sqlite3")
             embed_cache_path = os.path.join(self.cache_dir, f"bm25-{name}.pkl")
             self.npm[name] = NPM(Retrieval(self.db[name], cache_path, embed_cache_path, "bm25"),
                                  "npm-single",
@@ -153,6 +174,7 @@ class FactScorer(object):
             assert len(topics)==len(atomic_facts), "`topics` and `atomic_facts` should have the same length"
         else: #Atomic FactGeneration
             if self.af_generator is None:
+                from factscore.atomic_facts import AtomicFactGenerator
                 self.af_generator = AtomicFactGenerator(model_name=self.afg_model,
                                                         demon_dir=os.path.join(self.data_dir, "demos"),
                                                         key_path=self.openai_key,
@@ -166,26 +188,30 @@ class FactScorer(object):
 
                 self.print_cost_estimates(total_words, task="atomic fact generation", model="davinci-003")
 
-            if verbose:
-                topics = tqdm(topics)
+            gens_iter = tqdm(generations) if verbose else generations
 
-            ## Start obtaining Atomic Facts for each generation 
-            atomic_facts = []
-            for topic, gen in zip(topics, generations):
-                # optionally, first detect if the response is abstained
-                response_abstained = is_response_abstained(gen, self.abstain_detection_type)
-                if response_abstained:
-                    atomic_facts.append(None)
-                    continue
+            # abstain detection is cheap string work; run it for all
+            # generations up front, off the generation critical path
+            abstained = [is_response_abstained(gen, self.abstain_detection_type)
+                         for gen in generations]
+
+            ## Start obtaining Atomic Facts for each generation
+            def run_af_generation(gen, response_abstained):
                 # continue only when the response is not abstained
+                if response_abstained:
+                    return None
                 curr_afs, _ = self.af_generator.run(gen)
-                curr_afs = [fact for _, facts in curr_afs for fact in facts]
-                if len(curr_afs)==0:
-                    atomic_facts.append(None)
-                else:
-                    atomic_facts.append(curr_afs)
-                if len(atomic_facts) % 10 == 0:
-                    self.af_generator.save_cache()
+                curr_afs = list(chain.from_iterable(facts for _, facts in curr_afs))
+                return curr_afs if len(curr_afs) > 0 else None
+
+            if "ChatGPT" in self.afg_model:
+                # API calls are latency-bound, so fan them out over threads;
+                # local models run on the GPU and stay serial
+                with ThreadPoolExecutor(max_workers=32) as executor:
+                    atomic_facts = list(executor.map(run_af_generation, gens_iter, abstained))
+            else:
+                atomic_facts = [run_af_generation(gen, response_abstained)
+                                for gen, response_abstained in zip(gens_iter, abstained)]
 
             assert len(atomic_facts)==len(topics)
             self.af_generator.save_cache()
@@ -202,33 +228,39 @@ class FactScorer(object):
 
             self.print_cost_estimates(total_words, task="factscore evaluation", model="gpt-3.5-turbo")
 
+        # warm the retrieval cache with one batched encoder call over all
+        # (topic, atom) pairs before scoring; done before the tqdm wrap so the
+        # comprehension does not consume the progress bar
+        if self.lm:
+            topic_atoms = [(topic, atom.strip())
+                           for topic, facts in zip(topics, atomic_facts) if facts is not None
+                           for atom in facts]
+            self.retrieval[knowledge_source].get_passages_batch(topic_atoms, k=5)
+
         if verbose:
             topics = tqdm(topics)
 
-        scores = []
-        init_scores = []
+        # collect the decisions first, then do the score math in one shot
         decisions = []
-        # 
         for topic, generation, facts in zip(topics, generations, atomic_facts):
             if facts is None:
                 decisions.append(None)
-            else:
-                decision = self._get_score(topic, generation, facts, knowledge_source)
-                if decision is None:
-                    decisions.append(None)
-                    continue
-                # Score is the average number of "is_supported" for generation
-                score = np.mean([d["is_supported"] for d in decision])
-                
-                if gamma:
-                    init_scores.append(score)
-                    penalty = 1.0 if len(facts)>gamma else np.exp(1-gamma/len(facts))
-                    score = penalty * score
-                
-                decisions.append(decision)
-                scores.append(score)
-                if len(scores) % 10 == 0:
-                    self.save_cache()
+                continue
+            decisions.append(self._get_score(topic, generation, facts, knowledge_source))
+            # one mid-run checkpoint instead of a pickle dump every ten topics
+            if len(decisions) == len(topics) // 2:
+                self.save_cache()
+
+        supported = [np.array([d["is_supported"] for d in decision])
+                     for decision in decisions if decision is not None]
+        # Score is the average number of "is_supported" for generation
+        init_scores = np.array([s.mean() for s in supported])
+        if gamma:
+            n_facts = np.array([len(s) for s in supported])
+            penalties = np.where(n_facts > gamma, 1.0, np.exp(1 - gamma / n_facts))
+            scores = penalties * init_scores
+        else:
+            scores = init_scores
 
         self.save_cache()
 
@@ -245,25 +277,22 @@ class FactScorer(object):
         return out
 
     def _get_score(self, topic, generation, atomic_facts, knowledge_source, cost_estimate=None):
-        decisions = []
         total_words = 0
+        atoms = [atom.strip() for atom in atomic_facts]
 
-        # Prompt Construction
-        for atom in atomic_facts:
-            atom = atom.strip()
-            if self.lm:
+        if self.lm:
+            # Pass 1: retrieval + prompt construction for every atom
+            prompts = []
+            for atom in atoms:
                 self.logger.debug("Retrieving passages from %s", knowledge_source)
                 passages = self.retrieval[knowledge_source].get_passages(topic, atom, k=5)
                 if not passages:
                     return None
-                definition = "Answer the question about {} based on the given context.\n\n".format(topic)
-                context = ""
-                for psg_idx, psg in enumerate(reversed(passages)):
-                    context += "Title: {}\nText: {}\n\n".format(psg["title"], psg["text"].replace("<s>", "").replace("</s>", ""))
-                definition += context.strip()
-                if definition[-1] not in string.punctuation:
-                    definition += "."
-                prompt = "{}\n\nInput: {} True or False?\nAnswer:".format(definition.strip(), atom.strip())
+                context = "\n\n".join("Title: {}\nText: {}".format(psg["title"], psg["text"].replace("<s>", "").replace("</s>", ""))
+                                      for psg in reversed(passages)).strip()
+                if context[-1] not in string.punctuation:
+                    context += "."
+                prompt = _PROMPT_TEMPLATE.format(topic=topic, context=context, atom=atom)
 
                 if cost_estimate:
                     if cost_estimate == "consider_cache" and (prompt.strip() + "_0") not in self.lm.cache_dict:
@@ -272,46 +301,82 @@ class FactScorer(object):
                         total_words += len(prompt.split())
                     continue
 
-                output = self.lm.generate(prompt)
+                prompts.append(prompt)
+
+            if cost_estimate:
+                return total_words
+
+            # NPM prefilter: the nonparametric probability is far cheaper
+            # than a forward through the 8B model, so clear-cut atoms skip
+            # the LLM entirely and only the ambiguous band goes through it
+            if "npm" in self.model_name:
+                npprobs = [self.npm[knowledge_source].get_probabilty(topic, atom) for atom in atoms]
+                is_supported_all = [None if 0.05 <= npprob <= 0.95 else bool(npprob > 0.95)
+                                    for npprob in npprobs]
+                lm_indices = [i for i, is_supported in enumerate(is_supported_all) if is_supported is None]
+                prompts = [prompts[i] for i in lm_indices]
+                self.logger.debug("NPM prefilter: %d/%d atoms sent to the LLM", len(lm_indices), len(atoms))
+            else:
+                npprobs = None
+                lm_indices = list(range(len(atoms)))
+                is_supported_all = [None for _ in atoms]
+
+            # Pass 2+3: read the True/False logits directly when the lm
+            # supports it, skipping the autoregressive decode altogether
+            if not prompts:
+                lm_supported = []
+            elif hasattr(self.lm, "score_true_false"):
+                tf_scores = self.lm.score_true_false(prompts)
+                lm_supported = (tf_scores[:, 0] > tf_scores[:, 1]).tolist()
+                self.logger.debug("-------------------")
+                self.logger.debug(f'\nLogits:\nTrue: {tf_scores[:, 0]}\nFalse: {tf_scores[:, 1]}\nis_supported: {lm_supported}')
+                self.logger.debug("-------------------")
+            else:
+                # Pass 2: one batched generate over all atoms of the topic
+                outputs = self.lm.generate_batch(prompts)
 
-                if isinstance(output[1], np.ndarray) and self.lm.logits:
+                # Pass 3: decide True/False for all atoms at once; OpenAIModel
+                # and CLM define no logits attribute
+                if getattr(self.lm, "logits", False) and all(isinstance(output[1], np.ndarray) for output in outputs):
                     # TODO: assert with tokenizer vocab len
-                    logits = np.array(output[1])
-                    # when logits are available,
-                    true_score = logits[self.lm.true_id]
-                    false_score = logits[self.lm.false_id]
-                    is_supported = true_score > false_score
-                    is_supported = is_supported.item()
+                    logits = np.stack([output[1] for output in outputs])
+                    true_scores = logits[:, self.lm.true_id].reshape(-1)
+                    false_scores = logits[:, self.lm.false_id].reshape(-1)
+                    lm_supported = (true_scores > false_scores).tolist()
                     self.logger.debug("-------------------")
-                    self.logger.debug(f"Prompt: {prompt}")
-                    self.logger.debug(f'\nLogits:\nTrue: {true_score}\nFalse: {false_score}\nis_supported: {is_supported}')
-                    self.logger.debug(f'Output: {output[0]}')
+                    self.logger.debug(f'\nLogits:\nTrue: {true_scores}\nFalse: {false_scores}\nis_supported: {lm_supported}')
                     self.logger.debug("-------------------")
                 else:
                     # when logits are unavailable
-                    generated_answer = output[0].lower()
-                    if "true" in generated_answer or "false" in generated_answer:
-                        if "true" in generated_answer and "false" not in generated_answer:
-                            is_supported = True
-                        elif "false" in generated_answer and "true" not in generated_answer:
-                            is_supported = False
+                    lm_supported = []
+                    for output in outputs:
+                        generated_answer = output[0].lower()
+                        if "true" in generated_answer or "false" in generated_answer:
+                            if "true" in generated_answer and "false" not in generated_answer:
+                                is_supported = True
+                            elif "false" in generated_answer and "true" not in generated_answer:
+                                is_supported = False
+                            else:
+                                is_supported = generated_answer.index("true") > generated_answer.index("false")
                         else:
-                            is_supported = generated_answer.index("true") > generated_answer.index("false")
-                    else:
-                        is_supported = all([keyword not in generated_answer.lower().translate(str.maketrans("", "", string.punctuation)).split() for keyword in ["not", "cannot", "unknown", "information"]])
+                            is_supported = _NEG_KEYWORDS.isdisjoint(generated_answer.translate(_PUNCT_TABLE).split())
+                        lm_supported.append(is_supported)
 
-            else:
-                is_supported = True
+            # scatter the LLM verdicts back over the prefiltered slots
+            for i, is_supported in zip(lm_indices, lm_supported):
+                is_supported_all[i] = is_supported
+        else:
+            npprobs = None
+            is_supported_all = [True for _ in atoms]
 
+        decisions = []
+        for idx, (atom, is_supported) in enumerate(zip(atoms, is_supported_all)):
             if is_supported and "npm" in self.model_name:
-                npprob = self.npm[knowledge_source].get_probabilty(topic, atom)
+                npprob = npprobs[idx] if npprobs is not None else self.npm[knowledge_source].get_probabilty(topic, atom)
                 is_supported = npprob > 0.3
 
             decisions.append({"atom": atom, "is_supported": is_supported})
-        if cost_estimate:
-            return total_words
-        else:
-            return decisions
+        return decisions
 
 def convert_to_serializable(obj):
     if isinstance(obj, np.bool_):
@@ -335,6 +400,17 @@ if __name__ == '__main__':
                         help="Name of the Atomic Fact Generation model.")
     parser.add_argument('--is_npm', action='store_true',
                         help="Flag to enable Non Parametric Model (NPM).")
+    parser.add_argument('--afv_draft_model', type=str, default=None,
+                        help="Draft model for speculative decoding of the AFV model, "
+                             "e.g. meta-llama/Llama-3.2-1B-Instruct (vLLM only).")
+    parser.add_argument('--afv_quantization', type=str, default=None,
+                        help="Quantization for the AFV model: the method of a prequantized "
+                             "checkpoint with vLLM (e.g. gptq, awq), or int8 for "
+                             "bitsandbytes loading with transformers.")
+    parser.add_argument('--backend', type=str, default=None, choices=["trtllm"],
+                        help="Inference backend override for the AFV model: trtllm runs a "
+                             "prebuilt FP8 TensorRT-LLM engine on Hopper/Blackwell GPUs. "
+                             "Also settable via OPENFACTSCORE_BACKEND.")
 
     # Directories and paths
     parser.add_argument('--data_dir', type=str, default=".cache/factscore",
@@ -392,7 +468,10 @@ if __name__ == '__main__':
         cache_dir=args.cache_dir,
         openai_key=args.openai_key,
         cost_estimate=args.cost_estimate,
-        abstain_detection_type=args.abstain_detection_type
+        abstain_detection_type=args.abstain_detection_type,
+        afv_draft_model=args.afv_draft_model,
+        afv_quantization=args.afv_quantization,
+        backend=args.backend
     )
 
     topics, generations, atomic_facts = [], [], []
@@ -1,7 +1,58 @@
 import pickle
 import os
 import time
+import hashlib
 import logging
+import sqlite3
+
+class SqliteCache(object):
+    """
+    Disk-backed replacement for the in-memory cache_dict. Entries are written
+    through to a sqlite table keyed by a sha256 of the prompt, so membership
+    tests stop hashing multi-KB strings in Python, the cache no longer lives
+    in process RAM, and saving is a near-free commit instead of a pickle dump
+    of the whole dict.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value BLOB)")
+        self.connection.commit()
+
+    @staticmethod
+    def _hash(key):
+        return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+    def __len__(self):
+        return self.connection.execute("SELECT count(*) FROM cache").fetchone()[0]
+
+    def __contains__(self, key):
+        cursor = self.connection.execute("SELECT 1 FROM cache WHERE key = ?", (self._hash(key),))
+        return cursor.fetchone() is not None
+
+    def __getitem__(self, key):
+        row = self.connection.execute("SELECT value FROM cache WHERE key = ?", (self._hash(key),)).fetchone()
+        if row is None:
+            raise KeyError(key)
+        return pickle.loads(row[0])
+
+    def __setitem__(self, key, value):
+        self.connection.execute("INSERT OR REPLACE INTO cache VALUES (?,?)",
+                                (self._hash(key), pickle.dumps(value)))
+
+    def get(self, key, default=None):
+        row = self.connection.execute("SELECT value FROM cache WHERE key = ?", (self._hash(key),)).fetchone()
+        if row is None:
+            return default
+        return pickle.loads(row[0])
+
+    def update(self, other):
+        for key, value in other.items():
+            self[key] = value
+
+    def commit(self):
+        self.connection.commit()
 
 class LM(object):
 
@@ -37,23 +88,52 @@ class LM(object):
         self.add_n += 1
         return generated
 
+    def generate_batch(self, prompts, sample_idx=0, max_sequence_length=2048, max_output_length=128):
+        """
+        Cache-aware batched version of `generate`. Only prompts missing from
+        the cache are sent to `_generate`, in a single call, so the underlying
+        model sees one batch instead of one request per prompt.
+        Returns a list of (generation, scores) tuples, one per prompt.
+        """
+        prompts = [prompt.strip() for prompt in prompts]
+        cache_keys = [f"{prompt}_{sample_idx}" for prompt in prompts]
+        results = [self.cache_dict.get(cache_key) for cache_key in cache_keys]
+
+        missing = [i for i, result in enumerate(results) if result is None]
+        if missing:
+            if self.model is None:
+                self.load_model()
+            batch_prompts = [prompts[i] for i in missing]
+            # same clamp as `generate`: True/False answers need one token
+            if all(prompt.endswith(" True or False?\nAnswer:") for prompt in batch_prompts):
+                max_output_length = 1
+            generations, scores = self._generate(batch_prompts,
+                                                 max_sequence_length=max_sequence_length,
+                                                 max_output_length=max_output_length)
+            for i, gen, score in zip(missing, generations, scores):
+                results[i] = (gen, score)
+                self.cache_dict[cache_keys[i]] = results[i]
+                self.add_n += 1
+        self.logger.debug("generate_batch: %d prompts, %d cache misses", len(prompts), len(missing))
+        return results
+
     def save_cache(self):
         if self.add_n == 0:
             return
 
-        # load the latest cache first, since if there were other processes running in parallel, cache might have been updated
-        for k, v in self.load_cache().items():
-            self.cache_dict[k] = v
-
-        with open(self.cache_file, "wb") as f:
-            pickle.dump(self.cache_dict, f)
+        # entries were written through to sqlite as they were added; flushing
+        # the transaction is all that is left
+        self.cache_dict.commit()
 
     def load_cache(self, allow_retry=True):
-        if os.path.exists(self.cache_file):
+        cache = SqliteCache(self.cache_file + ".sqlite3")
+
+        # migrate a pre-existing pickle cache once
+        if os.path.exists(self.cache_file) and len(cache) == 0:
             while True:
                 try:
                     with open(self.cache_file, "rb") as f:
-                        cache = pickle.load(f)
+                        legacy_cache = pickle.load(f)
                     break
                 except Exception as e:
                     if not allow_retry:
@@ -61,9 +141,9 @@ class LM(object):
                     print(e)
                     print ("Pickle Error: Retry in 5sec...")
                     print(self.cache_file)
-                    time.sleep(5)        
-        else:
-            cache = {}
+                    time.sleep(5)
+            cache.update(legacy_cache)
+            cache.commit()
         return cache
 
 
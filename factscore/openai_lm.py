@@ -24,27 +24,39 @@ class OpenAIModel(LM):
         openai.api_key = api_key.strip()
         self.model = self.model_name
 
-    def _generate(self, prompt, max_sequence_length=2048, max_output_length=128):
+    def _generate(self, prompts, max_sequence_length=2048, max_output_length=128):
         if self.add_n % self.save_interval == 0:
             self.save_cache()
         # return a tuple of string (generated text) and metadata (any format)
         # This should be about generating a response from the prompt, no matter what the application is
-        if self.model_name == "ChatGPT":
-            # Construct the prompt send to ChatGPT
-            message = [{"role": "user", "content": prompt}]
-            # Call API
-            response = call_ChatGPT(message, temp=self.temp, max_len=max_sequence_length)
-            # Get the output from the response
-            output = response["choices"][0]["message"]["content"]
-            return output, response
-        elif self.model_name == "InstructGPT":
-            # Call API
-            response = call_GPT3(prompt, temp=self.temp)
-            # Get the output from the response
-            output = response["choices"][0]["text"]
-            return output, response
-        else:
-            raise NotImplementedError()
+        # the API takes one prompt per request, so a list is served by looping
+        is_single = type(prompts)==str
+        if is_single:
+            prompts = [prompts]
+
+        generations = []
+        responses = []
+        for prompt in prompts:
+            if self.model_name == "ChatGPT":
+                # Construct the prompt send to ChatGPT
+                message = [{"role": "user", "content": prompt}]
+                # Call API
+                response = call_ChatGPT(message, temp=self.temp, max_len=max_sequence_length)
+                # Get the output from the response
+                output = response["choices"][0]["message"]["content"]
+            elif self.model_name == "InstructGPT":
+                # Call API
+                response = call_GPT3(prompt, temp=self.temp)
+                # Get the output from the response
+                output = response["choices"][0]["text"]
+            else:
+                raise NotImplementedError()
+            generations.append(output)
+            responses.append(response)
+
+        if is_single:
+            return generations[0], responses[0]
+        return generations, responses
 
 def call_ChatGPT(message, model_name="gpt-3.5-turbo", max_len=1024, temp=0.7, verbose=False):
     # call GPT-3 API until result is provided and then return it
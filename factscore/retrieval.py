@@ -1,6 +1,7 @@
 import json
 import time
 import os
+import hashlib
 import logging
 
 import sqlite3
@@ -143,36 +144,96 @@ class Retrieval(object):
         assert self.batch_size is not None
     
     def load_cache(self):
-        if os.path.exists(self.cache_path):
-            print(self.cache_path)
-            with open(self.cache_path, "r") as f:
-                self.cache = json.load(f)
-        else:
-            self.cache = {}
-        if os.path.exists(self.embed_cache_path):
-            with open(self.embed_cache_path, "rb") as f:
-                self.embed_cache = pkl.load(f)
+        # the passage cache lives in sqlite: opening it is O(1) and saving
+        # upserts only the new keys instead of rewriting one growing json file
+        self.cache_connection = sqlite3.connect(self.cache_path, check_same_thread=False)
+        cursor = self.cache_connection.cursor()
+        cursor.execute("CREATE TABLE IF NOT EXISTS passages (key TEXT PRIMARY KEY, value TEXT)")
+        self.cache_connection.commit()
+        self.cache = {}  # in-memory layer over the sqlite store
+
+        # migrate a pre-existing whole-file json cache once
+        legacy_path = os.path.splitext(self.cache_path)[0] + ".json"
+        if os.path.exists(legacy_path):
+            cursor.execute("SELECT count(*) FROM passages")
+            if cursor.fetchone()[0]==0:
+                print(legacy_path)
+                with open(legacy_path, "r") as f:
+                    legacy_cache = json.load(f)
+                cursor.executemany("INSERT OR REPLACE INTO passages VALUES (?,?)",
+                                   [(key, json.dumps(value)) for key, value in legacy_cache.items()])
+                self.cache_connection.commit()
+
+        self.embed_cache = {}
+        if self.retrieval_type=="bm25":
+            # BM25 objects cannot be memory-mapped; keep the pickle
+            if os.path.exists(self.embed_cache_path):
+                with open(self.embed_cache_path, "rb") as f:
+                    self.embed_cache = pkl.load(f)
         else:
-            self.embed_cache = {}
-    
+            # gtr passage vectors are stored as one .npy per topic and opened
+            # with mmap_mode="r", so large embedding sets never sit in RAM
+            self.embed_dir = os.path.splitext(self.embed_cache_path)[0] + ".embeds"
+            os.makedirs(self.embed_dir, exist_ok=True)
+            # migrate a pre-existing pickle embed cache once
+            if os.path.exists(self.embed_cache_path) and not os.listdir(self.embed_dir):
+                with open(self.embed_cache_path, "rb") as f:
+                    for topic, vectors in pkl.load(f).items():
+                        np.save(self._embed_path(topic), vectors)
+
     def save_cache(self):
         if self.add_n > 0:
-            if os.path.exists(self.cache_path):
-                with open(self.cache_path, "r") as f:
-                    new_cache = json.load(f)
-                self.cache.update(new_cache)
-            
-            with open(self.cache_path, "w") as f:
-                json.dump(self.cache, f)
-        
-        if self.add_n_embed > 0:
+            # new keys are upserted as they are added; just commit them
+            self.cache_connection.commit()
+
+        if self.add_n_embed > 0 and self.retrieval_type=="bm25":
             if os.path.exists(self.embed_cache_path):
                 with open(self.embed_cache_path, "rb") as f:
                     new_cache = pkl.load(f)
                 self.embed_cache.update(new_cache)
-            
-            with open(self.embed_cache_path, "wb") as f:
+
+            # write atomically so a crash mid-dump cannot corrupt the cache
+            tmp_path = self.embed_cache_path + ".tmp"
+            with open(tmp_path, "wb") as f:
                 pkl.dump(self.embed_cache, f)
+            os.replace(tmp_path, self.embed_cache_path)
+        # gtr embeddings are persisted as they are added, nothing left to do
+
+    def _cache_get(self, cache_key):
+        if cache_key in self.cache:
+            return self.cache[cache_key]
+        cursor = self.cache_connection.cursor()
+        cursor.execute("SELECT value FROM passages WHERE key = ?", (cache_key,))
+        row = cursor.fetchone()
+        if row is None:
+            return None
+        self.cache[cache_key] = json.loads(row[0])
+        return self.cache[cache_key]
+
+    def _cache_put(self, cache_key, passages):
+        self.cache[cache_key] = passages
+        self.cache_connection.execute("INSERT OR REPLACE INTO passages VALUES (?,?)",
+                                      (cache_key, json.dumps(passages)))
+        self.add_n += 1
+
+    def _embed_path(self, topic):
+        # topics can contain characters that are not filename-safe
+        return os.path.join(self.embed_dir, hashlib.sha1(topic.encode("utf-8")).hexdigest() + ".npy")
+
+    def _get_topic_vectors(self, topic):
+        if topic in self.embed_cache:
+            return self.embed_cache[topic]
+        path = self._embed_path(topic)
+        if os.path.exists(path):
+            self.embed_cache[topic] = np.load(path, mmap_mode="r")
+            return self.embed_cache[topic]
+        return None
+
+    def _put_topic_vectors(self, topic, vectors):
+        np.save(self._embed_path(topic), vectors)
+        # keep the mmap'd view so the resident copy can be paged out
+        self.embed_cache[topic] = np.load(self._embed_path(topic), mmap_mode="r")
+        self.add_n_embed += 1
 
     def get_bm25_passages(self, topic, query, passages, k):
         if topic in self.embed_cache:
@@ -189,13 +250,11 @@ class Retrieval(object):
         self.logger.debug(f"topic: {topic}, retrieval_query: {retrieval_query},k={k} passages:\n{passages}")
         if self.encoder is None:
             self.load_encoder()
-        if topic in self.embed_cache:
-            passage_vectors = self.embed_cache[topic]
-        else:
+        passage_vectors = self._get_topic_vectors(topic)
+        if passage_vectors is None:
             inputs = [psg["title"] + " " + psg["text"].replace("<s>", "").replace("</s>", "") for psg in passages]
             passage_vectors = self.encoder.encode(inputs, batch_size=self.batch_size, device=self.encoder.device)
-            self.embed_cache[topic] = passage_vectors
-            self.add_n_embed += 1
+            self._put_topic_vectors(topic, passage_vectors)
         query_vectors = self.encoder.encode([retrieval_query], 
                                             batch_size=self.batch_size,
                                             device=self.encoder.device)[0]
@@ -203,26 +262,82 @@ class Retrieval(object):
         indices = np.argsort(-scores)[:k]
         return [passages[i] for i in indices]
 
+    def get_passages_batch(self, topic_questions, k):
+        """
+        Warm the passage cache for many (topic, question) pairs at once: all
+        uncached passages and all queries go through the encoder in single
+        batched calls instead of one forward per pair. bm25 retrieval has no
+        encoder, so it simply falls back to get_passages.
+        """
+        if self.retrieval_type=="bm25":
+            for topic, question in topic_questions:
+                self.get_passages(topic, question, k)
+            return
+
+        # collect the pairs that are not cached yet
+        pending = []
+        pending_keys = set()
+        for topic, question in topic_questions:
+            retrieval_query = topic + " " + question.strip()
+            cache_key = topic + "#" + retrieval_query
+            if cache_key in pending_keys or self._cache_get(cache_key) is not None:
+                continue
+            passages = self.db.get_text_from_title(topic)
+            if not passages:
+                self.logger.debug(f"No Passages for {topic}  | {question}")
+                continue
+            pending.append((topic, retrieval_query, cache_key, passages))
+            pending_keys.add(cache_key)
+
+        if not pending:
+            return
+        if self.encoder is None:
+            self.load_encoder()
+
+        # embed the passages of all uncached topics in one encoder call
+        uncached = {}
+        for topic, _, _, passages in pending:
+            if topic not in uncached and self._get_topic_vectors(topic) is None:
+                uncached[topic] = passages
+        if uncached:
+            inputs = []
+            offsets = {}
+            for topic, passages in uncached.items():
+                offsets[topic] = (len(inputs), len(inputs) + len(passages))
+                inputs += [psg["title"] + " " + psg["text"].replace("<s>", "").replace("</s>", "") for psg in passages]
+            passage_vectors = self.encoder.encode(inputs, batch_size=self.batch_size, device=self.encoder.device)
+            for topic, (start, end) in offsets.items():
+                self._put_topic_vectors(topic, passage_vectors[start:end])
+
+        # embed all queries in one encoder call and rank per pair
+        query_vectors = self.encoder.encode([query for _, query, _, _ in pending],
+                                            batch_size=self.batch_size,
+                                            device=self.encoder.device)
+        for (topic, _, cache_key, passages), query_vector in zip(pending, query_vectors):
+            scores = np.inner(query_vector, self._get_topic_vectors(topic))
+            indices = np.argsort(-scores)[:k]
+            self._cache_put(cache_key, [passages[i] for i in indices])
+
     def get_passages(self, topic, question, k):
         self.logger.debug(f"retrieving passages with {self.retrieval_type}")
         retrieval_query = topic + " " + question.strip()
         cache_key = topic + "#" + retrieval_query
-        
-        if cache_key not in self.cache:
+
+        cached = self._cache_get(cache_key)
+        if cached is None:
             passages = self.db.get_text_from_title(topic)
             if not passages:
                 self.logger.debug(f"No Passages for {topic}  | {question}")
                 return None
 
             if self.retrieval_type=="bm25":
-                self.cache[cache_key] = self.get_bm25_passages(topic, retrieval_query, passages, k)
+                cached = self.get_bm25_passages(topic, retrieval_query, passages, k)
             else:
-                self.cache[cache_key] = self.get_gtr_passages(topic, retrieval_query, passages, k)
-            assert len(self.cache[cache_key]) in [k, len(passages)]
-            self.add_n += 1
-        
-            
-        return self.cache[cache_key]
+                cached = self.get_gtr_passages(topic, retrieval_query, passages, k)
+            assert len(cached) in [k, len(passages)]
+            self._cache_put(cache_key, cached)
+
+        return cached
 
         
         